@@ -0,0 +1,99 @@
+# binary_index.py - Binary-quantized vector search with int8 and FP32 rescoring
+import logging
+from collections import namedtuple
+from typing import List, Tuple
+
+import faiss
+import numpy as np
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
+
+logger = logging.getLogger(__name__)
+
+def quantize_binary(vectors: np.ndarray) -> np.ndarray:
+    """Pack the sign bit of each dimension into uint8 codes (384 dims -> 48 bytes)"""
+    return np.packbits(vectors > 0, axis=-1)
+
+def quantize_int8(vectors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Scale each vector into int8 codes (384 dims -> 384 bytes) plus one fp16 scale per vector"""
+    scales = np.abs(vectors).max(axis=1) / 127
+    scales[scales == 0] = 1.0
+    codes = np.round(vectors / scales[:, None]).astype(np.int8)
+    return codes, scales.astype(np.float16)
+
+# Everything a search reads, swapped in as one object by build()
+_IndexState = namedtuple("_IndexState", ["index", "codes", "scales", "vectors", "documents", "rows"])
+
+class BinaryVectorIndex:
+    """In-memory FAISS binary index over the stored chunks.
+
+    A search takes ``k * rescore_multiplier ** 2`` candidates by Hamming distance,
+    narrows them to ``k * rescore_multiplier`` by the FP32 query against int8-quantized
+    document vectors, then reranks those with the full FP32 vectors.
+    """
+
+    def __init__(self, dim: int = 384, rescore_multiplier: int = 4):
+        self.dim = dim
+        self.rescore_multiplier = rescore_multiplier
+        self._state = _IndexState(faiss.IndexBinaryFlat(dim), np.empty((0, dim), dtype=np.int8),
+                                  np.empty(0, dtype=np.float16), np.empty((0, dim), dtype=np.float32), [], {})
+
+    def load_from_chroma(self, db):
+        """Rebuild the index from the vectors already stored in a Chroma collection"""
+        data = db.get(include=["embeddings", "documents", "metadatas"])
+        stored = data.get("embeddings")
+        vectors = np.asarray(stored if stored is not None else [], dtype=np.float32).reshape(-1, self.dim)
+        documents = [Document(page_content=text, metadata=metadata or {})
+                     for text, metadata in zip(data["documents"], data["metadatas"])]
+        self.build(vectors, documents)
+
+    def build(self, vectors: np.ndarray, documents: List[Document]):
+        """Replace the indexed chunks; searches in flight keep using the previous state"""
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.clip(norms, 1e-12, None)
+        index = faiss.IndexBinaryFlat(self.dim)
+        if len(documents):
+            index.add(quantize_binary(vectors))
+        codes, scales = quantize_int8(vectors)
+        rows = {doc.metadata.get("hash"): row for row, doc in enumerate(documents)}
+        self._state = _IndexState(index, codes, scales, vectors, documents, rows)
+        logger.info(f"Binary index built with {len(documents)} chunks")
+
+    def search(self, query_vector: List[float], k: int) -> List[Document]:
+        """Return the k chunks most similar to the query vector"""
+        state = self._state
+        if not state.documents:
+            return []
+
+        query = np.asarray(query_vector, dtype=np.float32).reshape(1, -1)
+        candidates = min(k * self.rescore_multiplier ** 2, len(state.documents))
+        _, ids = state.index.search(quantize_binary(query), candidates)
+        ids = ids[0][ids[0] >= 0]
+
+        # Narrow the Hamming candidates with the FP32 query against the int8 vectors
+        shortlist = k * self.rescore_multiplier
+        if len(ids) > shortlist:
+            approx = (state.codes[ids] @ query[0]) * state.scales[ids]
+            ids = ids[np.argpartition(-approx, shortlist)[:shortlist]]
+
+        # Rescore the shortlist with exact cosine similarity
+        scores = state.vectors[ids] @ query[0]
+        return [state.documents[i] for i in ids[np.argsort(-scores)[:k]]]
+
+    def vectors_for(self, documents: List[Document]) -> np.ndarray:
+        """Stored FP32 unit vectors of indexed chunks; chunks from an older build are skipped"""
+        state = self._state
+        found = [state.rows[doc.metadata.get("hash")] for doc in documents if doc.metadata.get("hash") in state.rows]
+        return state.vectors[found]
+
+class BinaryRetriever(BaseRetriever):
+    """LangChain retriever backed by a BinaryVectorIndex"""
+    index: BinaryVectorIndex
+    embeddings: Embeddings
+    k: int = 4
+
+    def _get_relevant_documents(self, query: str, *,
+                                run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        return self.index.search(self.embeddings.embed_query(query), self.k)
@@ -1,10 +1,15 @@
 # bot.py
 import os
+import asyncio
+import aiofiles
 import discord
 from discord import app_commands, ui
 from dotenv import load_dotenv
-from rag import get_rag_bot, build_index
+from response_cache import ResponseCache
+from guardrails import ResponseQuality
 import logging
+import time
+from collections import Counter
 from datetime import datetime
 
 # Ensure docs folder exists
@@ -32,20 +37,22 @@ intents.message_content = True  # Enable message content intent
 bot = discord.Client(intents=intents)
 tree = app_commands.CommandTree(bot)
 
-# Build RAG index and load QA bot
-build_index()
-qa = get_rag_bot()
-
-# Statistics tracking
-bot_stats = {
-    'total_queries': 0,
-    'high_confidence_responses': 0,
-    'medium_confidence_responses': 0,
-    'low_confidence_responses': 0,
-    'hallucination_risks': 0,
-    'guardrail_warnings': 0
+# The QA bot (qa), answer cache (response_cache) and build_index come from rag at startup below
+
+# Statistics tracking; missing keys read as 0
+bot_stats = Counter()
+
+# Response quality -> statistics counter
+_QUALITY_STAT_KEYS = {
+    ResponseQuality.HIGH_CONFIDENCE: 'high_confidence_responses',
+    ResponseQuality.MEDIUM_CONFIDENCE: 'medium_confidence_responses',
+    ResponseQuality.LOW_CONFIDENCE: 'low_confidence_responses',
+    ResponseQuality.HALLUCINATION_RISK: 'hallucination_risks',
 }
 
+# (total_queries, message) for the last /botstats reply; every counter changes together with the total
+_stats_cache = None
+
 
 # ---------------- Permission Helpers ---------------- #
 def _user_is_admin(user: discord.abc.User) -> bool:
@@ -59,6 +66,116 @@ def _user_is_admin(user: discord.abc.User) -> bool:
 def _interaction_is_admin(interaction: discord.Interaction) -> bool:
     return _user_is_admin(interaction.user)
 
+# ---------------- Document Registry ---------------- #
+# In-memory set of filenames in the docs folder, kept current by !adddoc/removedoc
+# and rescanned at most every DOCS_RESCAN_INTERVAL seconds to catch outside changes
+DOCS_RESCAN_INTERVAL = 5.0  # seconds
+
+_docs_set = set(os.listdir(docs_folder))
+_docs_last_scan = time.monotonic()
+
+def _get_docs():
+    """Return the known document filenames, rescanning the folder if the registry is stale"""
+    global _docs_last_scan
+    if time.monotonic() - _docs_last_scan > DOCS_RESCAN_INTERVAL:
+        _docs_set.clear()
+        _docs_set.update(os.listdir(docs_folder))
+        _docs_last_scan = time.monotonic()
+    return _docs_set
+
+# ---------------- Query Batching ---------------- #
+# Concurrent /ask queries are collected for a short window and answered with one qa.abatch call
+MAX_BATCH = 8
+BATCH_WINDOW = 0.025  # seconds
+
+_pending_queries = None  # asyncio.Queue of (query, future), created once the event loop runs
+_batch_worker_task = None
+_background_tasks = set()  # keeps references to fire-and-forget tasks
+
+async def _submit_query(query: str) -> dict:
+    """Queue a query for the batch worker and wait for its result"""
+    future = asyncio.get_running_loop().create_future()
+    await _pending_queries.put((query, future))
+    return await future
+
+async def _run_batch(items):
+    queries = [query for query, _ in items]
+    try:
+        # The lookup embeds queries, so it runs in a thread. The misses are answered on the loop:
+        # qa.abatch needs executor threads itself, so no executor thread may wait on it
+        results, misses = await asyncio.to_thread(response_cache.lookup_batch, queries)
+        if misses:
+            fresh = await qa.abatch([miss.query for miss in misses])
+            response_cache.store_batch(results, misses, fresh)
+    except Exception as e:
+        for _, future in items:
+            if not future.done():
+                future.set_exception(e)
+        return
+    for (_, future), result in zip(items, results):
+        if not future.done():
+            future.set_result(result)
+
+async def _batch_worker():
+    loop = asyncio.get_running_loop()
+    while True:
+        items = [await _pending_queries.get()]
+        deadline = loop.time() + BATCH_WINDOW
+        while len(items) < MAX_BATCH:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                items.append(await asyncio.wait_for(_pending_queries.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        # Run the batch in its own task so the next one can be collected meanwhile
+        task = asyncio.create_task(_run_batch(items))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+
+# ---------------- Debounced Reindexing ---------------- #
+# Document changes arriving within REINDEX_DELAY seconds of each other share one rebuild
+REINDEX_DELAY = 2.0  # seconds
+
+_reindex_task = None  # rebuild still waiting out the delay, if any
+_reindex_done = None  # future resolved when that rebuild finishes
+_reindex_lock = None  # serializes rebuilds, created once the event loop runs
+
+async def _do_reindex(done: asyncio.Future):
+    global _reindex_task
+    await asyncio.sleep(REINDEX_DELAY)
+    # Past the delay this rebuild can no longer be superseded; later changes schedule a new one
+    _reindex_task = None
+    try:
+        async with _reindex_lock:
+            await asyncio.to_thread(build_index, docs_folder)
+        response_cache.clear()
+    except Exception as e:
+        done.set_exception(e)
+    else:
+        done.set_result(None)
+
+async def _reindex_debounced():
+    """Schedule an index rebuild and wait until the (possibly coalesced) rebuild completes"""
+    global _reindex_task, _reindex_done
+    if _reindex_task is not None:
+        # Restart the delay; callers already waiting carry over to the new task
+        _reindex_task.cancel()
+    else:
+        _reindex_done = asyncio.get_running_loop().create_future()
+    _reindex_task = asyncio.create_task(_do_reindex(_reindex_done))
+    _background_tasks.add(_reindex_task)
+    _reindex_task.add_done_callback(_background_tasks.discard)
+    await asyncio.shield(_reindex_done)
+
+@bot.event
+async def setup_hook():
+    global _pending_queries, _batch_worker_task, _reindex_lock
+    _pending_queries = asyncio.Queue()
+    _reindex_lock = asyncio.Lock()
+    _batch_worker_task = asyncio.create_task(_batch_worker())
+
 @bot.event
 async def on_ready():
     print(f" Logged in as {bot.user}")
@@ -72,13 +189,15 @@ async def on_ready():
 
 @tree.command(name="ask", description="Ask a question to the RAG bot")
 async def ask_command(interaction: discord.Interaction, query: str):
+    # Acknowledge right away; the answer is sent as a follow-up once the RAG chain finishes
+    await interaction.response.defer(thinking=True)
     try:
         # Log the query
-        logger.info(f"Query from {interaction.user}: {query[:100]}...")
-        bot_stats['total_queries'] += 1
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Query from {interaction.user}: {query[:100]}...")
         
-        # Get response with guardrails
-        result = qa.invoke(query)
+        # Get response with guardrails; the batch worker runs it off the event loop
+        result = await _submit_query(query)
         response = result['result']
         
         # Extract guardrail information
@@ -87,41 +206,53 @@ async def ask_command(interaction: discord.Interaction, query: str):
         confidence = guardrail_info.get('confidence_score', 0.0)
         warnings = guardrail_info.get('warnings', [])
         
-        # Update statistics
-        if quality == 'high_confidence':
-            bot_stats['high_confidence_responses'] += 1
-        elif quality == 'medium_confidence':
-            bot_stats['medium_confidence_responses'] += 1
-        elif quality == 'low_confidence':
-            bot_stats['low_confidence_responses'] += 1
-        elif quality == 'hallucination_risk':
-            bot_stats['hallucination_risks'] += 1
+        # Update statistics in a single call
+        updates = ['total_queries']
+        stat_key = _QUALITY_STAT_KEYS.get(quality)
+        if stat_key:
+            updates.append(stat_key)
+        if warnings:
+            updates.append('guardrail_warnings')
+        bot_stats.update(updates)
         
         if warnings:
-            bot_stats['guardrail_warnings'] += 1
             logger.warning(f"Guardrail warnings for query '{query[:50]}...': {warnings}")
         
         # Log response quality
-        logger.info(f"Response quality: {quality}, Confidence: {confidence:.2f}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Response quality: {quality}, Confidence: {confidence:.2f}")
         
         # Send response
-        await interaction.response.send_message(response)
+        await interaction.followup.send(response)
         
     except Exception as e:
         error_msg = str(e)
         logger.error(f"Error processing query '{query[:50]}...': {error_msg}")
         
         if "quota" in error_msg.lower() or "exceeded" in error_msg.lower():
-            await interaction.response.send_message(" Sorry, the AI quota has been exceeded. Please try again later or contact the bot admin.")
+            await interaction.followup.send(" Sorry, the AI quota has been exceeded. Please try again later or contact the bot admin.")
         else:
-            await interaction.response.send_message(f" An error occurred: {error_msg}")
+            await interaction.followup.send(f" An error occurred: {error_msg}")
 
 # Remove the adddoc_command function
 
+# Select options per document list, shared by the preview and remove dropdowns
+_options_cache = {}
+
+def _get_options(docs):
+    """Return select options for the given documents, reusing them for an unchanged list"""
+    key = tuple(sorted(docs))
+    options = _options_cache.get(key)
+    if options is None:
+        options = [discord.SelectOption(label=doc, value=doc) for doc in key]
+        _options_cache[key] = options
+    # Copy the list so a Select never mutates the cached one
+    return list(options)
+
 # --- Dropdown for previewing docs ---
 class PreviewDocDropdown(ui.Select):
     def __init__(self, docs):
-        options = [discord.SelectOption(label=doc, value=doc) for doc in docs]
+        options = _get_options(docs)
         super().__init__(placeholder="Select a document to preview...", options=options, min_values=1, max_values=1)
 
     async def callback(self, interaction: discord.Interaction):
@@ -129,8 +260,9 @@ class PreviewDocDropdown(ui.Select):
         file_path = os.path.join(docs_folder, filename)
 
         if os.path.exists(file_path):
-            with open(file_path, "r", encoding="utf-8", errors="ignore") as f:
-                content = f.read(500)  # show first 500 chars
+            async with aiofiles.open(file_path, "rb") as f:
+                raw = await f.read(500)  # show first 500 bytes
+            content = raw.decode("utf-8", errors="ignore")
             await interaction.response.edit_message(
                 content=f" **{filename}** Preview:\n```{content}...```",
                 view=None
@@ -150,7 +282,7 @@ async def listdocs_command(interaction: discord.Interaction):
         await interaction.response.send_message(" You must be an admin to use this command.", ephemeral=True)
         return
     if os.path.exists(docs_folder):
-        files = os.listdir(docs_folder)
+        files = sorted(_get_docs())
         if not files:
             await interaction.response.send_message(" No documents found in the docs folder.")
             return
@@ -162,6 +294,7 @@ async def listdocs_command(interaction: discord.Interaction):
 @app_commands.default_permissions(administrator=True)
 @tree.command(name="botstats", description="View bot statistics and guardrail information (admins only)")
 async def botstats_command(interaction: discord.Interaction):
+    global _stats_cache
     if not _interaction_is_admin(interaction):
         await interaction.response.send_message(" You must be an admin to use this command.", ephemeral=True)
         return
@@ -171,6 +304,11 @@ async def botstats_command(interaction: discord.Interaction):
         await interaction.response.send_message(" **Bot Statistics**\nNo queries processed yet.")
         return
     
+    # Reuse the last message while no new queries have been processed
+    if _stats_cache and _stats_cache[0] == total:
+        await interaction.response.send_message(_stats_cache[1])
+        return
+    
     # Calculate percentages
     high_pct = (bot_stats['high_confidence_responses'] / total) * 100
     medium_pct = (bot_stats['medium_confidence_responses'] / total) * 100
@@ -196,12 +334,13 @@ async def botstats_command(interaction: discord.Interaction):
 
 *Last updated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}*"""
     
+    _stats_cache = (total, stats_message)
     await interaction.response.send_message(stats_message)
 
 # --- Dropdown for removing docs ---
 class RemoveDocDropdown(ui.Select):
     def __init__(self, docs):
-        options = [discord.SelectOption(label=doc, value=doc) for doc in docs]
+        options = _get_options(docs)
         super().__init__(placeholder="Select a document to remove...", options=options, min_values=1, max_values=1)
 
     async def callback(self, interaction: discord.Interaction):
@@ -213,8 +352,12 @@ class RemoveDocDropdown(ui.Select):
 
         if os.path.exists(file_path):
             os.remove(file_path)
-            build_index(docs_folder)
-            await interaction.response.edit_message(content=f" `{filename}` removed and index updated.", view=None)
+            _docs_set.discard(filename)
+            _options_cache.clear()
+            # Reindexing (debounced, then the rebuild itself) can outlast Discord's response window, so defer first
+            await interaction.response.defer()
+            await _reindex_debounced()
+            await interaction.edit_original_response(content=f" `{filename}` removed and index updated.", view=None)
         else:
             await interaction.response.edit_message(content=f" File `{filename}` not found.", view=None)
 
@@ -230,7 +373,7 @@ async def removedoc_command(interaction: discord.Interaction):
         await interaction.response.send_message(" You must be an admin to use this command.", ephemeral=True)
         return
     if os.path.exists(docs_folder):
-        files = os.listdir(docs_folder)
+        files = sorted(_get_docs())
         if not files:
             await interaction.response.send_message(" No documents to remove.")
             return
@@ -250,11 +393,16 @@ async def on_message(message):
         if not _user_is_admin(message.author):
             await message.channel.send(" Only admins can add documents.")
             return
-        for attachment in message.attachments:
-            file_path = os.path.join(docs_folder, attachment.filename)
-            await attachment.save(file_path)
-            print(f" Saved {attachment.filename}")
-        build_index(docs_folder)
+        # Download all attachments concurrently
+        await asyncio.gather(*(
+            attachment.save(os.path.join(docs_folder, attachment.filename))
+            for attachment in message.attachments
+        ))
+        saved = [attachment.filename for attachment in message.attachments]
+        print(f" Saved {', '.join(saved)}")
+        _docs_set.update(saved)
+        _options_cache.clear()
+        await _reindex_debounced()
         await message.channel.send(" Document(s) added and indexed!")
     elif message.content.lower() == "!adddoc" and not message.attachments:
         # Still enforce admin check to avoid leaking usage to non-admins
@@ -265,4 +413,15 @@ async def on_message(message):
     
     # Removed process_commands since we're not using prefix commands
 
-bot.run(TOKEN)
+# Document loader worker processes re-import this module, so loading the RAG stack
+# (embedding models, Chroma, LLM client) is kept behind the guard
+if __name__ == "__main__":
+    from rag import get_rag_bot, build_index, embeddings
+    
+    qa = get_rag_bot()
+    
+    # Cache answers for repeated or near-identical questions; cleared whenever the index is rebuilt
+    response_cache = ResponseCache(embeddings.embed_query)
+    
+    build_index()
+    bot.run(TOKEN)
@@ -0,0 +1,79 @@
+# document_loader.py - Document parsing, kept light so worker processes can import it cheaply
+import mmap
+import os
+
+import pypdfium2 as pdfium
+from docling.datamodel.base_models import InputFormat
+from docling.datamodel.pipeline_options import AcceleratorDevice, PdfPipelineOptions
+from docling.document_converter import DocumentConverter, PdfFormatOption
+
+# Per-process converter settings, overridden in pool workers by configure_worker
+_num_threads = os.cpu_count() or 1
+_device = AcceleratorDevice.AUTO
+
+# File types load_file can parse: plain text plus the formats Docling converts
+SUPPORTED_EXTENSIONS = (
+    ".txt", ".pdf", ".docx", ".pptx", ".xlsx", ".md", ".html", ".htm", ".adoc", ".csv",
+    ".png", ".jpg", ".jpeg", ".tif", ".tiff", ".bmp", ".webp",
+)
+
+# Text files above this size are memory-mapped instead of read into a bytes copy
+MMAP_THRESHOLD = 16 * 1024 * 1024
+
+# Converters per process, keyed by their settings; building one loads Docling's models
+_converters = {}
+
+def configure_worker(num_threads):
+    """Pool initializer: split the cores between workers and keep them off the GPU"""
+    global _num_threads, _device
+    _num_threads = num_threads
+    # Many workers would contend for one GPU; each gets its share of the CPU instead
+    _device = AcceleratorDevice.CPU
+    # Drop any converter inherited from the parent, which was built with its settings
+    _converters.clear()
+
+def _get_converter(do_ocr=False):
+    key = (do_ocr, _device, _num_threads)
+    if key not in _converters:
+        # OCR and table structure are the slowest pipeline stages; tables still come through as text
+        options = PdfPipelineOptions(do_ocr=do_ocr, do_table_structure=False, generate_page_images=False)
+        options.accelerator_options.num_threads = _num_threads
+        options.accelerator_options.device = _device
+        _converters[key] = DocumentConverter(
+            format_options={InputFormat.PDF: PdfFormatOption(pipeline_options=options)}
+        )
+    return _converters[key]
+
+def _has_text_layer(file_path, max_pages=3):
+    """Return True if any of the first pages has extractable text, i.e. the PDF is not a scan"""
+    pdf = pdfium.PdfDocument(file_path)
+    try:
+        for index in range(min(len(pdf), max_pages)):
+            page = pdf[index]
+            textpage = page.get_textpage()
+            text = textpage.get_text_range()
+            textpage.close()
+            page.close()
+            if text.strip():
+                return True
+        return False
+    finally:
+        pdf.close()
+
+def _read_text(file_path):
+    """Read a UTF-8 text file with a single decode call"""
+    with open(file_path, "rb") as f:
+        if os.fstat(f.fileno()).st_size > MMAP_THRESHOLD:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return str(mm, "utf-8", "replace")
+        return f.read().decode("utf-8", errors="replace")
+
+def load_file(file_path):
+    """Use Docling to parse PDF, DOCX, TXT, or supported formats"""
+    if file_path.endswith(".txt"):
+        return _read_text(file_path)
+    else:
+        # Docling handles PDF, DOCX, PPTX, images, etc.; only image-only PDFs need OCR
+        do_ocr = file_path.lower().endswith(".pdf") and not _has_text_layer(file_path)
+        result = _get_converter(do_ocr).convert(file_path)
+        return result.document.export_to_markdown()
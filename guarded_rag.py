@@ -0,0 +1,119 @@
+# guarded_rag.py - Guardrail-wrapped RAG bot shared by the cloud and local backends
+import asyncio
+import functools
+import logging
+from typing import List
+
+from guardrails import create_safe_response, tokenize
+
+@functools.lru_cache(maxsize=4096)
+def _chunk_tokens(text: str) -> frozenset:
+    """Guardrail word set of one chunk; retrieved chunks repeat, so most lookups hit"""
+    return tokenize(text)
+
+class GuardedRAGBot:
+    """RAG bot with integrated guardrails for hallucination prevention"""
+    
+    def __init__(self, retriever, llm, prompt, guardrail_system, source_similarities=None):
+        self.retriever = retriever
+        self.llm = llm
+        self.prompt = prompt
+        self.guardrail_system = guardrail_system
+        # Optional (response, source_documents) -> cosine similarity per source, reported as coverage
+        self.source_similarities = source_similarities
+        self.logger = logging.getLogger(__name__)
+    
+    def invoke(self, query: str) -> dict:
+        """Invoke the RAG bot with guardrail validation"""
+        try:
+            # Retrieve, then answer from one joined context shared with the guardrails
+            source_documents = self.retriever.invoke(query)
+            pages = [doc.page_content for doc in source_documents]
+            context = "\n\n".join(pages)
+            response = self.llm.invoke(self.prompt.format(context=context, question=query))
+            return self._apply_guardrails(query, response, source_documents, pages, context)
+        except Exception as e:
+            return self._error_result(e)
+    
+    async def ainvoke(self, query: str) -> dict:
+        """Async invoke; question-side guardrail work runs while the LLM is answering"""
+        try:
+            source_documents = await self.retriever.ainvoke(query)
+            pages = [doc.page_content for doc in source_documents]
+            context = "\n\n".join(pages)
+            response, prepared = await asyncio.gather(
+                self.llm.ainvoke(self.prompt.format(context=context, question=query)),
+                asyncio.to_thread(self._prepare_guardrails, query, pages)
+            )
+            # Validation is CPU-bound; keep it off the event loop
+            return await asyncio.to_thread(self._apply_guardrails, query, response, source_documents,
+                                           pages, context, prepared)
+        except Exception as e:
+            return self._error_result(e)
+    
+    async def abatch(self, queries: List[str]) -> List[dict]:
+        """Answer several queries concurrently; errors are reported per query"""
+        return list(await asyncio.gather(*(self.ainvoke(query) for query in queries)))
+    
+    def _prepare_guardrails(self, query: str, pages: List[str]):
+        """Guardrail inputs that do not depend on the LLM answer"""
+        # Joining on whitespace means the context's word set is the union of the cached per-chunk sets
+        context_tokens = frozenset().union(*map(_chunk_tokens, pages))
+        return self.guardrail_system.prepare_question_features(query), context_tokens
+    
+    def _apply_guardrails(self, query: str, response, source_documents: list,
+                          pages: List[str], context: str, prepared=None) -> dict:
+        """Validate an LLM answer and wrap it with guardrail information"""
+        # Chat models return a message, plain LLMs a string
+        response = getattr(response, "content", response)
+        features, context_tokens = prepared if prepared is not None else self._prepare_guardrails(query, pages)
+        similarities = self.source_similarities(response, source_documents) if self.source_similarities else None
+        
+        # Run guardrail validation; the context already holds every source document
+        guardrail_result = self.guardrail_system.validate_response(
+            response=response,
+            question=query,
+            context=context,
+            context_tokens=context_tokens,
+            features=features,
+            source_similarities=similarities
+        )
+        
+        # Log validation results
+        self.logger.info(f"Guardrail validation - Quality: {guardrail_result.quality.value}, "
+                       f"Confidence: {guardrail_result.confidence_score:.2f}, "
+                       f"Warnings: {len(guardrail_result.warnings)}")
+        
+        if guardrail_result.warnings:
+            self.logger.warning(f"Guardrail warnings: {guardrail_result.warnings}")
+        
+        # Create safe response
+        safe_response = create_safe_response(response, guardrail_result)
+        
+        # Return enhanced result with guardrail information
+        return {
+            'result': safe_response,
+            'source_documents': source_documents,
+            'guardrail_result': {
+                'quality': guardrail_result.quality,
+                'confidence_score': guardrail_result.confidence_score,
+                'warnings': guardrail_result.warnings,
+                'suggestions': guardrail_result.suggestions,
+                'source_coverage': guardrail_result.source_coverage
+            }
+        }
+        
+    def _error_result(self, e: Exception) -> dict:
+        """Build the result returned when answering a question fails"""
+        self.logger.error(f"Error in GuardedRAGBot: {str(e)}")
+        return {
+            'result': f" An error occurred while processing your question: {str(e)}",
+            'source_documents': [],
+            'guardrail_result': {
+                'quality': 'error',
+                'confidence_score': 0.0,
+                'warnings': [f"System error: {str(e)}"],
+                'suggestions': ["Please try rephrasing your question"],
+                'source_coverage': 0.0
+            }
+        }
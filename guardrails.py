@@ -1,14 +1,71 @@
 # guardrails.py - Anti-hallucination and response validation system
 import re
 import logging
-from typing import Dict, List, Tuple, Optional
+from typing import Dict, List, Sequence, Tuple, Optional
 from dataclasses import dataclass
 from enum import Enum
 
-# Setup logging
-logging.basicConfig(level=logging.INFO)
+# Logging is configured by the entry point (bot.py)
 logger = logging.getLogger(__name__)
 
+# Source attribution phrases used when scoring confidence
+_SOURCE_ATTR_RE = re.compile(r'\b(according to|based on|from the document|as stated in)\b', re.IGNORECASE)
+
+# Word tokens, as the original \b\w+\b scans; \w is Unicode-aware, so curly quotes,
+# dashes and ellipses separate words just like ASCII punctuation
+_WORD_RE = re.compile(r'\w+')
+
+# Common words ignored when measuring word overlap
+_STOPWORDS = frozenset({'the', 'a', 'an', 'and', 'or', 'but', 'in', 'on', 'at', 'to', 'for', 'of', 'with', 'by', 'is', 'are', 'was', 'were', 'be', 'been', 'have', 'has', 'had', 'do', 'does', 'did', 'will', 'would', 'could', 'should', 'may', 'might', 'can', 'must'})
+
+def _words(text_lower: str) -> frozenset:
+    """Split already-lowercased text into a set of words"""
+    return frozenset(_WORD_RE.findall(text_lower))
+
+def _tokens(text: str) -> frozenset:
+    """Split text into a set of lowercase words"""
+    return _words(text.lower())
+
+def tokenize(text: str) -> frozenset:
+    """Word set used by the guardrail checks, for callers that cache tokens per source document"""
+    return _tokens(text)
+
+def _overlap_count(a: frozenset, b: frozenset) -> int:
+    """Count words present in both sets without building the intersection"""
+    smaller, larger = (a, b) if len(a) <= len(b) else (b, a)
+    return sum(1 for word in smaller if word in larger)
+
+# Responses shorter than this are flagged without running the detailed checks
+_MIN_RESPONSE_LENGTH = 50
+
+# Pattern scans only look at this many leading characters; longer responses are already flagged as very long
+_MAX_SCAN_LENGTH = 4000
+
+# Prefixes of the bot's own error messages, which are not worth validating
+_ERROR_RESPONSE_PREFIXES = ('Sorry, the AI quota', 'An error occurred')
+
+def _is_trivial_response(response: str) -> bool:
+    """Return True for responses too short or too generic to be worth scanning"""
+    return len(response) < _MIN_RESPONSE_LENGTH or response.lstrip().startswith(_ERROR_RESPONSE_PREFIXES)
+
+def _compile_patterns(patterns: List[str]) -> List[re.Pattern]:
+    """Compile patterns once, case-insensitively; each search stops at its first match"""
+    return [re.compile(p, re.IGNORECASE) for p in patterns]
+
+# Prompt instructions that steer the LLM away from hallucinating
+_ENHANCED_PROMPT_INSTRUCTIONS = """
+CRITICAL INSTRUCTIONS TO PREVENT HALLUCINATIONS:
+- ONLY use information explicitly stated in the provided context
+- If information is not in the context, say "I don't have that information in the provided documents"
+- Use phrases like "According to the document" or "Based on the provided context"
+- Avoid making claims about things not mentioned in the context
+- If uncertain, use phrases like "The document suggests" or "It appears that"
+- Never make up statistics, dates, or specific details not in the context
+- If asked about something not in the documents, politely explain you don't have that information
+- Always ground your responses in the provided source material
+- Use caution when making generalizations or broad statements
+"""
+
 class ResponseQuality(Enum):
     HIGH_CONFIDENCE = "high_confidence"
     MEDIUM_CONFIDENCE = "medium_confidence"
@@ -16,6 +73,23 @@ class ResponseQuality(Enum):
     UNCERTAIN = "uncertain"
     HALLUCINATION_RISK = "hallucination_risk"
 
+# Minimum confidence score for each quality level, checked from the top down. Only the 0.8
+# cut-off is documented (README); the lower ones split the rest of the range in 0.2 steps
+_QUALITY_THRESHOLDS = (
+    (0.8, ResponseQuality.HIGH_CONFIDENCE),
+    (0.6, ResponseQuality.MEDIUM_CONFIDENCE),
+    (0.4, ResponseQuality.LOW_CONFIDENCE),
+)
+
+# (hallucination risk detected, quality) -> downgraded quality; missing keys keep the quality
+_QUALITY_DOWNGRADE = {
+    (True, ResponseQuality.HIGH_CONFIDENCE): ResponseQuality.MEDIUM_CONFIDENCE,
+    (True, ResponseQuality.MEDIUM_CONFIDENCE): ResponseQuality.LOW_CONFIDENCE,
+    (True, ResponseQuality.LOW_CONFIDENCE): ResponseQuality.HALLUCINATION_RISK,
+    (True, ResponseQuality.UNCERTAIN): ResponseQuality.HALLUCINATION_RISK,
+    (True, ResponseQuality.HALLUCINATION_RISK): ResponseQuality.HALLUCINATION_RISK,
+}
+
 @dataclass
 class GuardrailResult:
     """Result of guardrail validation"""
@@ -26,6 +100,11 @@ class GuardrailResult:
     suggestions: List[str]
     source_coverage: float
 
+@dataclass
+class QuestionFeatures:
+    """Question-side validation inputs, which can be prepared before the response exists"""
+    question_tokens: frozenset
+
 class HallucinationDetector:
     """Detects potential hallucinations in AI responses"""
     
@@ -43,58 +122,80 @@ class HallucinationDetector:
         
         # Confidence indicators
         self.confidence_indicators = {
-            'high': [
-                r'\b(according to|based on|from the document|as stated in)\b',
-                r'\b(the document|the source|the text)\b',
-                r'\b(clearly|explicitly|specifically)\b',
-                r'\b(mentioned|described|outlined)\b'
-            ],
-            'medium': [
-                r'\b(likely|probably|suggests|indicates)\b',
-                r'\b(appears|seems|suggests)\b',
-                r'\b(may|might|could)\b'
-            ],
-            'low': [
-                r'\b(possibly|perhaps|maybe|potentially)\b',
-                r'\b(uncertain|unclear|unknown)\b',
-                r'\b(not specified|not mentioned|not clear)\b'
-            ]
+            level: _compile_patterns(patterns)
+            for level, patterns in {
+                'high': [
+                    r'\b(according to|based on|from the document|as stated in)\b',
+                    r'\b(the document|the source|the text)\b',
+                    r'\b(clearly|explicitly|specifically)\b',
+                    r'\b(mentioned|described|outlined)\b'
+                ],
+                'medium': [
+                    r'\b(likely|probably|suggests|indicates)\b',
+                    r'\b(appears|seems|suggests)\b',
+                    r'\b(may|might|could)\b'
+                ],
+                'low': [
+                    r'\b(possibly|perhaps|maybe|potentially)\b',
+                    r'\b(uncertain|unclear|unknown)\b',
+                    r'\b(not specified|not mentioned|not clear)\b'
+                ]
+            }.items()
         }
+        
+        # Overly confident language without proper attribution
+        self.overconfident_patterns = [
+            r'\b(always|never|all|every|none)\b(?!.*\b(?:according to|based on|from the document))\b',
+            r'\b(guaranteed|certain|definitely|absolutely)\b(?!.*\b(?:according to|based on|from the document))\b',
+            r'\b(proven|established|confirmed)\b(?!.*\b(?:according to|based on|from the document))\b'
+        ]
+        
+        self._hallucination_res = _compile_patterns(self.hallucination_patterns)
+        self._overconfident_res = _compile_patterns(self.overconfident_patterns)
     
-    def detect_hallucination_risk(self, response: str, context: str) -> Tuple[bool, List[str]]:
-        """Detect potential hallucination patterns in response"""
+    def detect_hallucination_risk(self, response: str, context: str,
+                                  context_tokens: Optional[frozenset] = None,
+                                  response_tokens: Optional[frozenset] = None) -> Tuple[bool, List[str]]:
+        """Detect potential hallucination patterns in response
+
+        ``context_tokens``/``response_tokens`` may be passed when the caller has
+        already tokenized the texts, to avoid scanning them again.
+        """
         warnings = []
         
+        scan_target = response if len(response) <= _MAX_SCAN_LENGTH else response[:_MAX_SCAN_LENGTH]
+        
         # Check for hallucination patterns
-        for pattern in self.hallucination_patterns:
-            if re.search(pattern, response, re.IGNORECASE):
-                warnings.append(f"Potential hallucination pattern detected: {pattern}")
+        for pattern in self._hallucination_res:
+            if pattern.search(scan_target):
+                warnings.append(f"Potential hallucination pattern detected: {pattern.pattern}")
         
         # Check if response makes claims not supported by context
-        if not self._is_response_grounded_in_context(response, context):
+        if not self._is_response_grounded_in_context(response, context, context_tokens, response_tokens):
             warnings.append("Response may contain information not found in provided context")
         
         # Check for overly confident language without source attribution
-        if self._has_overconfident_language(response):
+        if self._has_overconfident_language(scan_target):
             warnings.append("Response uses overly confident language without proper source attribution")
         
         return len(warnings) > 0, warnings
     
-    def _is_response_grounded_in_context(self, response: str, context: str) -> bool:
+    def _is_response_grounded_in_context(self, response: str, context: str,
+                                         context_tokens: Optional[frozenset] = None,
+                                         response_tokens: Optional[frozenset] = None) -> bool:
         """Check if response is grounded in the provided context"""
         if not context or not response:
             return False
         
         # Simple check: look for key terms from context in response
-        context_words = set(re.findall(r'\b\w+\b', context.lower()))
-        response_words = set(re.findall(r'\b\w+\b', response.lower()))
+        context_words = context_tokens if context_tokens is not None else _tokens(context)
+        response_words = response_tokens if response_tokens is not None else _tokens(response)
         
-        # Check for overlap (excluding common words)
-        common_words = {'the', 'a', 'an', 'and', 'or', 'but', 'in', 'on', 'at', 'to', 'for', 'of', 'with', 'by', 'is', 'are', 'was', 'were', 'be', 'been', 'have', 'has', 'had', 'do', 'does', 'did', 'will', 'would', 'could', 'should', 'may', 'might', 'can', 'must'}
-        context_words -= common_words
-        response_words -= common_words
+        # Check for overlap (excluding common words); stripping them from the
+        # response side is enough to keep them out of the overlap
+        response_words -= _STOPWORDS
         
-        overlap = len(context_words.intersection(response_words))
+        overlap = _overlap_count(response_words, context_words)
         total_unique_words = len(response_words)
         
         if total_unique_words == 0:
@@ -105,16 +206,7 @@ class HallucinationDetector:
     
     def _has_overconfident_language(self, response: str) -> bool:
         """Check for overly confident language without proper attribution"""
-        overconfident_patterns = [
-            r'\b(always|never|all|every|none)\b(?!.*\b(?:according to|based on|from the document))\b',
-            r'\b(guaranteed|certain|definitely|absolutely)\b(?!.*\b(?:according to|based on|from the document))\b',
-            r'\b(proven|established|confirmed)\b(?!.*\b(?:according to|based on|from the document))\b'
-        ]
-        
-        for pattern in overconfident_patterns:
-            if re.search(pattern, response, re.IGNORECASE):
-                return True
-        return False
+        return any(pattern.search(response) for pattern in self._overconfident_res)
 
 class ResponseValidator:
     """Validates response quality and appropriateness"""
@@ -132,38 +224,68 @@ class ResponseValidator:
             r'\b(opinion|belief|feeling)\b(?!.*\b(?:according to|based on)\b)',
             r'\b(you should|you must|you need to)\b',
         ]
+        
+        self._inappropriate_res = _compile_patterns(self.inappropriate_patterns)
+        self._off_topic_res = _compile_patterns(self.off_topic_indicators)
+        
+        # Confidence scoring markers, matched as lowercase substrings
+        self.uncertainty_markers = ['may', 'might', 'could', 'possibly', 'perhaps', 'maybe']
+        self.confidence_markers = ['clearly', 'explicitly', 'specifically', 'definitely']
     
-    def validate_response(self, response: str, question: str, context: str) -> GuardrailResult:
-        """Validate response for quality, appropriateness, and accuracy"""
+    def validate_response(self, response: str, question: str, context: str,
+                          context_tokens: Optional[frozenset] = None,
+                          response_tokens: Optional[frozenset] = None,
+                          response_lower: Optional[str] = None,
+                          question_tokens: Optional[frozenset] = None,
+                          source_coverage: Optional[float] = None) -> GuardrailResult:
+        """Validate response for quality, appropriateness, and accuracy
+
+        ``source_coverage`` may be passed when the caller already scored it, e.g.
+        by embedding similarity, to skip the word-overlap estimate.
+        """
+        # Short or error responses are flagged straight away without scanning
+        if _is_trivial_response(response):
+            too_short = len(response) < _MIN_RESPONSE_LENGTH
+            return GuardrailResult(
+                passed=False,
+                quality=ResponseQuality.UNCERTAIN,
+                confidence_score=0.0,
+                warnings=["Response is very short" if too_short else "Response is an error message"],
+                suggestions=["Provide more detailed information if available" if too_short else "Please try rephrasing your question"],
+                source_coverage=0.0
+            )
+        
         warnings = []
         suggestions = []
         
+        # Bound the pattern scans; length checks below still use the full response
+        scan_target = response if len(response) <= _MAX_SCAN_LENGTH else response[:_MAX_SCAN_LENGTH]
+        scan_lower = response_lower[:_MAX_SCAN_LENGTH] if response_lower is not None else scan_target.lower()
+        
         # Check for inappropriate content
-        if self._contains_inappropriate_content(response):
+        if self._contains_inappropriate_content(scan_target):
             warnings.append("Response may contain inappropriate content")
             suggestions.append("Reframe response to be more professional and appropriate")
         
         # Check for off-topic responses
-        if self._is_off_topic(response, question):
+        if self._is_off_topic(scan_target, question, response_tokens, question_tokens):
             warnings.append("Response may be off-topic")
             suggestions.append("Focus on answering the specific question asked")
         
-        # Check response length
+        # Check response length (short responses were handled above)
         if len(response) > 2000:
             warnings.append("Response is very long")
             suggestions.append("Consider breaking into smaller, more digestible parts")
-        elif len(response) < 50:
-            warnings.append("Response is very short")
-            suggestions.append("Provide more detailed information if available")
         
         # Calculate confidence score
-        confidence_score = self._calculate_confidence_score(response, context)
+        confidence_score = self._calculate_confidence_score(scan_target, context, scan_lower)
         
         # Determine quality level
         quality = self._determine_quality(confidence_score, warnings)
         
         # Calculate source coverage
-        source_coverage = self._calculate_source_coverage(response, context)
+        if source_coverage is None:
+            source_coverage = self._calculate_source_coverage(response, context, context_tokens, response_tokens)
         
         return GuardrailResult(
             passed=len(warnings) == 0,
@@ -174,73 +296,87 @@ class ResponseValidator:
             source_coverage=source_coverage
         )
     
+    def _determine_quality(self, confidence_score: float, warnings: List[str]) -> ResponseQuality:
+        """Map a confidence score to a quality level"""
+        for threshold, quality in _QUALITY_THRESHOLDS:
+            if confidence_score >= threshold:
+                return quality
+        return ResponseQuality.UNCERTAIN
+    
     def _contains_inappropriate_content(self, response: str) -> bool:
         """Check for inappropriate content patterns"""
-        for pattern in self.inappropriate_patterns:
-            if re.search(pattern, response, re.IGNORECASE):
-                return True
-        return False
+        return any(pattern.search(response) for pattern in self._inappropriate_res)
     
-    def _is_off_topic(self, response: str, question: str) -> bool:
+    def _is_off_topic(self, response: str, question: str,
+                      response_tokens: Optional[frozenset] = None,
+                      question_tokens: Optional[frozenset] = None) -> bool:
         """Check if response is off-topic"""
-        for pattern in self.off_topic_indicators:
-            if re.search(pattern, response, re.IGNORECASE):
-                return True
+        if any(pattern.search(response) for pattern in self._off_topic_res):
+            return True
         
         # Check if response addresses the question
-        question_words = set(re.findall(r'\b\w+\b', question.lower()))
-        response_words = set(re.findall(r'\b\w+\b', response.lower()))
+        question_words = question_tokens if question_tokens is not None else _tokens(question)
+        response_words = response_tokens if response_tokens is not None else _tokens(response)
         
         # Simple overlap check
-        overlap = len(question_words.intersection(response_words))
+        overlap = _overlap_count(question_words, response_words)
         return overlap < 2  # Very low overlap might indicate off-topic response
     
-    def _calculate_confidence_score(self, response: str, context: str) -> float:
+    def _calculate_confidence_score(self, response: str, context: str,
+                                    response_lower: Optional[str] = None) -> float:
         """Calculate confidence score based on various factors"""
         score = 0.5  # Base score
         
         # Check for source attribution
-        if re.search(r'\b(according to|based on|from the document|as stated in)\b', response, re.IGNORECASE):
+        if _SOURCE_ATTR_RE.search(response):
             score += 0.3
         
+        # Lowercase once for all marker checks; each marker present counts once
+        if response_lower is None:
+            response_lower = response.lower()
+        
         # Check for uncertainty markers
-        uncertainty_markers = ['may', 'might', 'could', 'possibly', 'perhaps', 'maybe']
-        uncertainty_count = sum(1 for marker in uncertainty_markers if marker in response.lower())
+        uncertainty_count = sum(1 for marker in self.uncertainty_markers if marker in response_lower)
         score -= uncertainty_count * 0.1
         
         # Check for confidence markers
-        confidence_markers = ['clearly', 'explicitly', 'specifically', 'definitely']
-        confidence_count = sum(1 for marker in confidence_markers if marker in response.lower())
+        confidence_count = sum(1 for marker in self.confidence_markers if marker in response_lower)
         score += confidence_count * 0.1
         
         # Check context grounding
-        if self._is_well_grounded(response, context):
+        if self._is_well_grounded(response, context, response_lower):
             score += 0.2
         
         return max(0.0, min(1.0, score))
     
-    def _is_well_grounded(self, response: str, context: str) -> bool:
+    def _is_well_grounded(self, response: str, context: str,
+                          response_lower: Optional[str] = None) -> bool:
         """Check if response is well-grounded in context"""
         if not context or not response:
             return False
         
+        if response_lower is None:
+            response_lower = response.lower()
+        
         # Look for specific references to context
         context_indicators = ['document', 'source', 'text', 'according to', 'based on']
-        return any(indicator in response.lower() for indicator in context_indicators)
+        return any(indicator in response_lower for indicator in context_indicators)
     
-    def _calculate_source_coverage(self, response: str, context: str) -> float:
+    def _calculate_source_coverage(self, response: str, context: str,
+                                   context_tokens: Optional[frozenset] = None,
+                                   response_tokens: Optional[frozenset] = None) -> float:
         """Calculate how well the response covers the available context"""
         if not context or not response:
             return 0.0
         
         # Simple word overlap calculation
-        context_words = set(re.findall(r'\b\w+\b', context.lower()))
-        response_words = set(re.findall(r'\b\w+\b', response.lower()))
+        context_words = context_tokens if context_tokens is not None else _tokens(context)
+        response_words = response_tokens if response_tokens is not None else _tokens(response)
         
         if not context_words:
             return 0.0
         
-        overlap = len(context_words.intersection(response_words))
+        overlap = _overlap_count(context_words, response_words)
         return min(1.0, overlap / len(context_words))
 
 class GuardrailSystem:
@@ -250,20 +386,53 @@ class GuardrailSystem:
         self.hallucination_detector = HallucinationDetector()
         self.response_validator = ResponseValidator()
     
-    def validate_response(self, response: str, question: str, context: str, source_documents: List[str] = None) -> GuardrailResult:
-        """Main validation function that runs all guardrails"""
-        logger.info(f"Validating response for question: {question[:100]}...")
+    def validate_response(self, response: str, question: str, context: str, source_documents: List[str] = None,
+                          context_tokens: Optional[frozenset] = None,
+                          features: Optional[QuestionFeatures] = None,
+                          source_similarities: Optional[Sequence[float]] = None) -> GuardrailResult:
+        """Main validation function that runs all guardrails
+
+        ``context_tokens`` may be passed when the caller already has the word set of
+        the full context, e.g. from ``tokenize`` results cached per source document.
+        ``features`` comes from ``prepare_question_features``, typically run while
+        the LLM is generating. ``source_similarities`` are the response's cosine
+        similarities to each source document; when given, source coverage reports
+        the best of them instead of the word-overlap estimate.
+        """
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Validating response for question: {question[:100]}...")
         
         # Combine all context sources
         full_context = context
         if source_documents:
             full_context += "\n\n".join(source_documents)
         
+        # Nothing for hallucination or grounding checks to work with; skip tokenizing the context
+        if _is_trivial_response(response):
+            return self.response_validator.validate_response(response, question, full_context)
+        
+        # Lowercase and tokenize once and share across all checks
+        response_lower = response.lower()
+        if context_tokens is None:
+            context_tokens = _words(full_context.lower())
+        response_tokens = _words(response_lower)
+        
         # Run hallucination detection
-        has_hallucination_risk, hallucination_warnings = self.hallucination_detector.detect_hallucination_risk(response, full_context)
+        has_hallucination_risk, hallucination_warnings = self.hallucination_detector.detect_hallucination_risk(
+            response, full_context, context_tokens, response_tokens)
+        
+        # Closeness to the nearest source in embedding space; reported only, never used to pass a check
+        source_coverage = None
+        if source_similarities is not None and len(source_similarities):
+            source_coverage = max(0.0, min(1.0, float(max(source_similarities))))
+            if logger.isEnabledFor(logging.DEBUG):
+                mean_similarity = sum(source_similarities) / len(source_similarities)
+                logger.debug(f"Source similarity - best: {source_coverage:.2f}, mean: {mean_similarity:.2f}")
         
         # Run response validation
-        validation_result = self.response_validator.validate_response(response, question, full_context)
+        validation_result = self.response_validator.validate_response(
+            response, question, full_context, context_tokens, response_tokens, response_lower,
+            features.question_tokens if features is not None else None, source_coverage)
         
         # Combine results
         all_warnings = validation_result.warnings + hallucination_warnings
@@ -274,14 +443,7 @@ class GuardrailSystem:
             all_suggestions.append("Use more cautious language when uncertain")
         
         # Adjust quality based on hallucination risk
-        quality = validation_result.quality
-        if has_hallucination_risk:
-            if quality == ResponseQuality.HIGH_CONFIDENCE:
-                quality = ResponseQuality.MEDIUM_CONFIDENCE
-            elif quality == ResponseQuality.MEDIUM_CONFIDENCE:
-                quality = ResponseQuality.LOW_CONFIDENCE
-            else:
-                quality = ResponseQuality.HALLUCINATION_RISK
+        quality = _QUALITY_DOWNGRADE.get((has_hallucination_risk, validation_result.quality), validation_result.quality)
         
         return GuardrailResult(
             passed=len(all_warnings) == 0,
@@ -292,20 +454,13 @@ class GuardrailSystem:
             source_coverage=validation_result.source_coverage
         )
     
+    def prepare_question_features(self, question: str) -> QuestionFeatures:
+        """Compute the response-independent parts of validation for a question"""
+        return QuestionFeatures(question_tokens=_tokens(question))
+    
     def get_enhanced_prompt_instructions(self) -> str:
         """Get enhanced prompt instructions to prevent hallucinations"""
-        return """
-CRITICAL INSTRUCTIONS TO PREVENT HALLUCINATIONS:
-- ONLY use information explicitly stated in the provided context
-- If information is not in the context, say "I don't have that information in the provided documents"
-- Use phrases like "According to the document" or "Based on the provided context"
-- Avoid making claims about things not mentioned in the context
-- If uncertain, use phrases like "The document suggests" or "It appears that"
-- Never make up statistics, dates, or specific details not in the context
-- If asked about something not in the documents, politely explain you don't have that information
-- Always ground your responses in the provided source material
-- Use caution when making generalizations or broad statements
-"""
+        return _ENHANCED_PROMPT_INSTRUCTIONS
 
 def create_safe_response(response: str, guardrail_result: GuardrailResult) -> str:
     """Create a safe response based on guardrail validation"""
@@ -0,0 +1,68 @@
+# onnx_embeddings.py - INT8-quantized MiniLM embeddings on ONNX Runtime
+import logging
+import os
+from typing import List
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+logger = logging.getLogger(__name__)
+
+MODEL_ID = "sentence-transformers/all-MiniLM-L6-v2"
+QUANTIZED_MODEL_FILE = "model_quantized.onnx"
+
+def export_quantized_model(model_dir: str):
+    """Export MiniLM to ONNX and quantize it to INT8 for AVX-512 VNNI CPUs"""
+    from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+    from transformers import AutoTokenizer
+
+    logger.info(f"Exporting INT8 ONNX model for {MODEL_ID} to {model_dir}")
+    model = ORTModelForFeatureExtraction.from_pretrained(MODEL_ID, export=True)
+    model.save_pretrained(model_dir)
+    AutoTokenizer.from_pretrained(MODEL_ID).save_pretrained(model_dir)
+
+    quantizer = ORTQuantizer.from_pretrained(model)
+    qconfig = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=True)
+    quantizer.quantize(save_dir=model_dir, quantization_config=qconfig)
+
+class OnnxMiniLMEmbeddings(Embeddings):
+    """Mean-pooled, L2-normalized MiniLM embeddings (384-d) from an INT8 ONNX Runtime session"""
+
+    def __init__(self, model_dir: str = "./onnx_minilm", batch_size: int = 128, max_length: int = 256):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        model_path = os.path.join(model_dir, QUANTIZED_MODEL_FILE)
+        if not os.path.exists(model_path):
+            export_quantized_model(model_dir)
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.session = ort.InferenceSession(model_path, providers=["CPUExecutionProvider"])
+        self._input_names = {i.name for i in self.session.get_inputs()}
+        self.batch_size = batch_size
+        self.max_length = max_length  # Matches sentence-transformers' max_seq_length for MiniLM
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """Embed texts in length-sorted batches so each batch pads to a similar length"""
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        vectors = [None] * len(texts)
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start:start + self.batch_size]
+            for i, vector in zip(batch, self._encode([texts[i] for i in batch])):
+                vectors[i] = vector.tolist()
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._encode([text])[0].tolist()
+
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        inputs = self.tokenizer(texts, padding=True, truncation=True,
+                                max_length=self.max_length, return_tensors="np")
+        feed = {name: value.astype(np.int64) for name, value in inputs.items() if name in self._input_names}
+        hidden = self.session.run(None, feed)[0]
+
+        # Mean pooling over real tokens, then L2 normalization (same as the sentence-transformers model)
+        mask = inputs["attention_mask"][..., None].astype(np.float32)
+        pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        return pooled / np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
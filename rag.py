@@ -1,89 +1,115 @@
 # rag.py
 import os
+import functools
+import gc
+import hashlib
+import multiprocessing
+import sqlite3
+import contextlib
+import torch
+import numpy as np
 from dotenv import load_dotenv
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_community.embeddings import HuggingFaceEmbeddings
+from langchain.embeddings import CacheBackedEmbeddings
+from langchain.storage import LocalFileStore
 from langchain_chroma import Chroma
+import chromadb
+from chromadb.config import Settings
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.prompts import PromptTemplate
-from langchain.chains import RetrievalQA
-from docling.document_converter import DocumentConverter
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
 from langchain.schema import Document
-from guardrails import GuardrailSystem, create_safe_response
+from guardrails import GuardrailSystem
+from guarded_rag import GuardedRAGBot
+from onnx_embeddings import OnnxMiniLMEmbeddings
+from binary_index import BinaryVectorIndex, BinaryRetriever
+from response_cache import CachedQueryEmbeddings
+from document_loader import load_file, configure_worker, SUPPORTED_EXTENSIONS
 import logging
 
 load_dotenv()
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 
-# Setup logging
-logging.basicConfig(level=logging.INFO)
+# Logging is configured by the entry point (bot.py)
 logger = logging.getLogger(__name__)
 
-# Setup embeddings + vector DB (using local HuggingFace embeddings - free!)
-embeddings = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")
-db = Chroma(persist_directory="./chroma_db", embedding_function=embeddings)
+def create_embeddings():
+    """Pick the fastest MiniLM backend: half-precision PyTorch on GPU, INT8 ONNX Runtime on CPU"""
+    if torch.cuda.is_available():
+        # Run the encoder on tensor cores; TF32 covers any matmuls left in FP32
+        torch.backends.cuda.matmul.allow_tf32 = True
+        dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+        return HuggingFaceEmbeddings(
+            model_name="all-MiniLM-L6-v2",
+            model_kwargs={"device": "cuda", "model_kwargs": {"torch_dtype": dtype}},
+            encode_kwargs={"batch_size": 256, "normalize_embeddings": True},
+        )
+    
+    try:
+        return OnnxMiniLMEmbeddings()
+    except ImportError as e:
+        logger.warning(f"ONNX Runtime backend unavailable ({e}), using PyTorch embeddings")
+    
+    # Large batches keep the encoder busy while indexing; normalized vectors make cosine a plain dot product
+    return HuggingFaceEmbeddings(
+        model_name="all-MiniLM-L6-v2",
+        model_kwargs={"device": "cpu"},
+        encode_kwargs={"batch_size": 128, "normalize_embeddings": True},
+    )
 
-# Initialize guardrail system
-guardrail_system = GuardrailSystem()
+# Setup embeddings + vector DB (using local MiniLM embeddings - free!)
+# Chunk embeddings are cached on disk, so rebuilds only run the model on new or changed text
+base_embeddings = create_embeddings()
+EMBEDDING_NAMESPACE = f"all-MiniLM-L6-v2-{type(base_embeddings).__name__}"
+# Repeated questions (and the answer cache's lookups) reuse their query embedding from memory
+embeddings = CachedQueryEmbeddings(CacheBackedEmbeddings.from_bytes_store(
+    base_embeddings, LocalFileStore("./emb_cache"), namespace=EMBEDDING_NAMESPACE
+))
 
-def load_file(file_path):
-    """Use Docling to parse PDF, DOCX, TXT, or supported formats"""
-    if file_path.endswith(".txt"):
-        with open(file_path, "r", encoding="utf-8") as f:
-            return f.read()
-    else:
-        # Docling handles PDF, DOCX, PPTX, images, etc.
-        converter = DocumentConverter()
-        result = converter.convert(file_path)
-        return result.document.export_to_markdown()
+CHROMA_DIR = "./chroma_db"
+COLLECTION_NAME = "docs"
 
-def build_index(docs_folder="docs"):
-    """Scan folder and rebuild vector DB"""
-    all_docs = []
+def _enable_wal(path):
+    """Switch Chroma's SQLite file to write-ahead logging; the mode persists in the file"""
+    try:
+        with contextlib.closing(sqlite3.connect(os.path.join(path, "chroma.sqlite3"))) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+    except sqlite3.Error as e:
+        logger.warning(f"Could not enable WAL for Chroma: {e}")
 
-    if not os.path.exists(docs_folder):
-        os.makedirs(docs_folder)
+def _tune_sqlite_connection():
+    """Relax fsyncs and enlarge the page cache on this thread's Chroma connection (best effort)"""
+    try:
+        from chromadb.db.impl.sqlite import SqliteDB
+        conn = chroma_client._system.instance(SqliteDB)._conn_pool.connect()
+        conn.execute("PRAGMA synchronous=NORMAL")  # Safe with WAL: commits no longer fsync
+        conn.execute("PRAGMA cache_size=-262144")  # 256 MB
+    except Exception as e:
+        logger.debug(f"Skipping SQLite tuning, Chroma internals differ: {e}")
 
-    for file_name in os.listdir(docs_folder):
-        file_path = os.path.join(docs_folder, file_name)
-        if os.path.isfile(file_path):
-            print(f"    Parsing {file_name}")
-            content = load_file(file_path)
-            if content.strip():
-                # Wrap in LangChain Document
-                all_docs.append(Document(page_content=content, metadata={"source": file_name}))
-
-    if all_docs:
-        # Smaller chunks for local models with limited context
-        splitter = RecursiveCharacterTextSplitter(
-            chunk_size=1000,  # Smaller for local models
-            chunk_overlap=200  # Better overlap for continuity
-        )
-        splits = splitter.split_documents(all_docs)
-        db.reset_collection()
-        db.add_documents(splits)
-        print(" DB updated with latest docs.")
-    else:
-        print(" No docs found.")
+chroma_client = chromadb.PersistentClient(path=CHROMA_DIR, settings=Settings(anonymized_telemetry=False))
+_enable_wal(CHROMA_DIR)
+db = Chroma(client=chroma_client, collection_name=COLLECTION_NAME, embedding_function=embeddings)
 
-def get_rag_bot():
-    llm = ChatGoogleGenerativeAI(
-        model="gemini-2.0-flash-exp",  # Gemini 2.0 Flash Live model
-        google_api_key=GEMINI_API_KEY,
-        max_tokens=2000,  # Output token limit
-        temperature=0.1,
-        max_retries=3,
-    )
-    
-    # Enhanced system prompt with anti-hallucination instructions
-    template = f"""You are a helpful Discord bot that answers questions based on the provided documents. 
+# Retrieval runs on binary-quantized copies of the Chroma vectors, refreshed by build_index
+vector_index = BinaryVectorIndex()
+
+# Initialize guardrail system
+guardrail_system = GuardrailSystem()
+
+# Enhanced system prompt with anti-hallucination instructions; the guardrail text is static,
+# so the template is rendered and parsed once at import
+_ENHANCED_INSTRUCTIONS = guardrail_system.get_enhanced_prompt_instructions()
+_TEMPLATE = f"""You are a helpful Discord bot that answers questions based on the provided documents. 
 
 Context from documents:
 {{context}}
 
 Question: {{question}}
 
-{guardrail_system.get_enhanced_prompt_instructions()}
+{_ENHANCED_INSTRUCTIONS}
 
 Instructions:
 - Be friendly and conversational, like a Discord bot
@@ -98,88 +124,177 @@ Instructions:
 - Never make up information not present in the context
 
 Answer:"""
+
+QA_PROMPT = PromptTemplate(
+    template=_TEMPLATE,
+    input_variables=["context", "question"]
+)
+
+# Never fork the live bot: its gRPC channel and thread pools are not fork-safe. Workers come
+# from a forkserver that preloads only the loader (spawn where unavailable); they re-import
+# bot.py, which keeps its heavy setup behind the __main__ guard
+if "forkserver" in multiprocessing.get_all_start_methods():
+    _POOL_CONTEXT = multiprocessing.get_context("forkserver")
+    _POOL_CONTEXT.set_forkserver_preload(["document_loader"])
+else:
+    _POOL_CONTEXT = multiprocessing.get_context("spawn")
+
+# Smaller chunks for local models with limited context; shared across files and rebuilds
+SPLITTER = RecursiveCharacterTextSplitter(
+    chunk_size=1000,  # Smaller for local models
+    chunk_overlap=200,  # Better overlap for continuity
+    separators=["\n\n", "\n", ". ", " ", ""],
+    is_separator_regex=False,
+    keep_separator=False,
+    length_function=len
+)
+
+# Documents above LARGE_DOCUMENT_SIZE characters are pre-split on paragraphs into
+# segments of about COARSE_SEGMENT_SIZE characters before the recursive splitter runs
+LARGE_DOCUMENT_SIZE = 1_000_000
+COARSE_SEGMENT_SIZE = 100_000
+
+# Chunks buffered before each write to Chroma, and files parsed between garbage collections
+INDEX_FLUSH_SIZE = 512
+GC_INTERVAL = 16
+
+# Rows per Chroma add call; stays below the client's maximum batch size
+CHROMA_ADD_BATCH = 5000
+
+def _load_files(paths):
+    """Parse files in parallel across CPU cores, yielding (path, content) in order"""
+    if len(paths) <= 1:
+        yield from zip(paths, map(load_file, paths))
+        return
+    workers = min(len(paths), os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=_POOL_CONTEXT, initializer=configure_worker,
+                             initargs=(max(1, (os.cpu_count() or 1) // workers),)) as executor:
+        # Only a few files in flight, so parsed text never piles up ahead of the indexer
+        pending = deque()
+        for path in paths:
+            pending.append((path, executor.submit(load_file, path)))
+            if len(pending) >= 2 * workers:
+                path, future = pending.popleft()
+                yield path, future.result()
+        while pending:
+            path, future = pending.popleft()
+            yield path, future.result()
+
+def _chunk_id(doc):
+    """Stable id for a chunk, so unchanged chunks keep their id across rebuilds"""
+    key = f"{EMBEDDING_NAMESPACE}\0{doc.metadata['source']}\0{doc.page_content}"
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+def _split_document(doc):
+    """Split a document into chunks, bounding the recursive splitter's work on huge inputs"""
+    text = doc.page_content
+    if len(text) <= LARGE_DOCUMENT_SIZE:
+        return SPLITTER.split_documents([doc])
     
-    QA_PROMPT = PromptTemplate(
-        template=template, 
-        input_variables=["context", "question"]
-    )
+    segments, current, size = [], [], 0
+    for block in text.split("\n\n"):
+        if current and size + len(block) > COARSE_SEGMENT_SIZE:
+            segments.append("\n\n".join(current))
+            current, size = [], 0
+        current.append(block)
+        size += len(block) + 2
+    if current:
+        segments.append("\n\n".join(current))
+    return SPLITTER.create_documents(segments, metadatas=[doc.metadata] * len(segments))
+
+def _add_chunks(chunks):
+    """Embed new chunks in one call and bulk-write them to Chroma under their content-hash ids"""
+    texts = [chunk.page_content for chunk in chunks]
+    vectors = embeddings.embed_documents(texts)
+    ids = [chunk.metadata["hash"] for chunk in chunks]
+    metadatas = [chunk.metadata for chunk in chunks]
+    for start in range(0, len(ids), CHROMA_ADD_BATCH):
+        end = start + CHROMA_ADD_BATCH
+        db._collection.add(ids=ids[start:end], embeddings=vectors[start:end],
+                           documents=texts[start:end], metadatas=metadatas[start:end])
+
+def build_index(docs_folder="docs"):
+    """Scan folder and sync the vector DB, adding new chunks and deleting stale ones"""
+    if not os.path.exists(docs_folder):
+        os.makedirs(docs_folder)
+
+    # Connection settings are per thread, and rebuilds run on worker threads
+    _tune_sqlite_connection()
+    existing_ids = set(db.get(include=[])["ids"])
+    current_ids = set()
+    buffer = []
+    added = 0
+    indexed_files = 0
+
+    # scandir reuses the directory listing's file type; skip hidden files and formats we cannot parse
+    with os.scandir(docs_folder) as entries:
+        paths = [entry.path for entry in entries
+                 if entry.is_file(follow_symlinks=False)
+                 and not entry.name.startswith(".")
+                 and entry.name.lower().endswith(SUPPORTED_EXTENSIONS)]
+    for count, (file_path, content) in enumerate(_load_files(paths), 1):
+        file_name = os.path.basename(file_path)
+        print(f"    Parsed {file_name}")
+        if content.strip():
+            indexed_files += 1
+            # Split each file on its own so its text can be freed before the next one
+            doc = Document(page_content=content, metadata={"source": file_name})
+            for split in _split_document(doc):
+                split.metadata["hash"] = chunk_id = _chunk_id(split)
+                if chunk_id not in current_ids:
+                    current_ids.add(chunk_id)
+                    if chunk_id not in existing_ids:
+                        buffer.append(split)
+            del doc
+        del content
+        
+        if len(buffer) >= INDEX_FLUSH_SIZE:
+            _add_chunks(buffer)
+            added += len(buffer)
+            buffer.clear()
+        if count % GC_INTERVAL == 0:
+            gc.collect()
     
-    # Take advantage of context - retrieve fewer documents for smaller models
-    retriever = db.as_retriever(search_kwargs={"k": 4})
+    if buffer:
+        _add_chunks(buffer)
+        added += len(buffer)
     
-    # Create the base RAG chain
-    rag_chain = RetrievalQA.from_chain_type(
-        llm=llm,
-        chain_type="stuff",
-        retriever=retriever,
-        return_source_documents=True,
-        chain_type_kwargs={"prompt": QA_PROMPT}
-    )
+    # Chunks of modified or removed files no longer match any current id
+    stale_ids = existing_ids - current_ids
+    if stale_ids:
+        db.delete(ids=list(stale_ids))
     
-    # Wrap with guardrails
-    return GuardedRAGBot(rag_chain, guardrail_system)
+    if indexed_files:
+        print(f" DB updated with latest docs ({added} added, {len(stale_ids)} removed).")
+    else:
+        print(" No docs found.")
+    
+    vector_index.load_from_chroma(db)
 
-class GuardedRAGBot:
-    """RAG bot with integrated guardrails for hallucination prevention"""
+def _source_similarities(response: str, source_documents: list):
+    """Cosine similarity of the response to each source chunk's indexed vector, or None if none are indexed"""
+    sources = vector_index.vectors_for(source_documents)
+    if not len(sources):
+        return None
+    # Embedded with the base model so responses do not crowd the query cache
+    vector = np.asarray(base_embeddings.embed_query(response), dtype=np.float32)
+    vector /= max(float(np.linalg.norm(vector)), 1e-12)
+    return sources @ vector
+
+@functools.lru_cache(maxsize=1)
+def get_rag_bot():
+    """Build the guarded QA bot once; later calls reuse it and its LLM client"""
+    llm = ChatGoogleGenerativeAI(
+        model="gemini-2.0-flash-exp",  # Gemini 2.0 Flash Live model
+        google_api_key=GEMINI_API_KEY,
+        max_tokens=2000,  # Output token limit
+        temperature=0.1,
+        max_retries=3,
+        transport="grpc",  # One long-lived channel, reused by every query
+    )
     
-    def __init__(self, rag_chain, guardrail_system):
-        self.rag_chain = rag_chain
-        self.guardrail_system = guardrail_system
-        self.logger = logging.getLogger(__name__)
+    # Take advantage of context - retrieve fewer documents for smaller models
+    retriever = BinaryRetriever(index=vector_index, embeddings=embeddings, k=4)
     
-    def invoke(self, query: str) -> dict:
-        """Invoke the RAG bot with guardrail validation"""
-        try:
-            # Get response from RAG chain
-            result = self.rag_chain.invoke(query)
-            response = result['result']
-            source_documents = result.get('source_documents', [])
-            
-            # Extract context from source documents
-            context = "\n\n".join([doc.page_content for doc in source_documents])
-            
-            # Run guardrail validation
-            guardrail_result = self.guardrail_system.validate_response(
-                response=response,
-                question=query,
-                context=context,
-                source_documents=[doc.page_content for doc in source_documents]
-            )
-            
-            # Log validation results
-            self.logger.info(f"Guardrail validation - Quality: {guardrail_result.quality.value}, "
-                           f"Confidence: {guardrail_result.confidence_score:.2f}, "
-                           f"Warnings: {len(guardrail_result.warnings)}")
-            
-            if guardrail_result.warnings:
-                self.logger.warning(f"Guardrail warnings: {guardrail_result.warnings}")
-            
-            # Create safe response
-            safe_response = create_safe_response(response, guardrail_result)
-            
-            # Return enhanced result with guardrail information
-            return {
-                'result': safe_response,
-                'source_documents': source_documents,
-                'guardrail_result': {
-                    'quality': guardrail_result.quality.value,
-                    'confidence_score': guardrail_result.confidence_score,
-                    'warnings': guardrail_result.warnings,
-                    'suggestions': guardrail_result.suggestions,
-                    'source_coverage': guardrail_result.source_coverage
-                }
-            }
-            
-        except Exception as e:
-            self.logger.error(f"Error in GuardedRAGBot: {str(e)}")
-            return {
-                'result': f" An error occurred while processing your question: {str(e)}",
-                'source_documents': [],
-                'guardrail_result': {
-                    'quality': 'error',
-                    'confidence_score': 0.0,
-                    'warnings': [f"System error: {str(e)}"],
-                    'suggestions': ["Please try rephrasing your question"],
-                    'source_coverage': 0.0
-                }
-            }
+    # Wrap with guardrails
+    return GuardedRAGBot(retriever, llm, QA_PROMPT, guardrail_system, source_similarities=_source_similarities)
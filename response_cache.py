@@ -0,0 +1,157 @@
+# response_cache.py - Exact and semantic caching of RAG answers and query embeddings
+import logging
+import threading
+from collections import OrderedDict, deque, namedtuple
+from typing import Callable, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+logger = logging.getLogger(__name__)
+
+def normalize_query(query: str) -> str:
+    """Collapse case and whitespace so trivially different queries share a key"""
+    return " ".join(query.lower().split())
+
+# A query the cache could not answer: its normalized key, embedding (or None) and batch positions
+CacheMiss = namedtuple("CacheMiss", ["query", "key", "vector", "indices"])
+
+class CachedQueryEmbeddings(Embeddings):
+    """Embeddings wrapper that memoizes ``embed_query`` by normalized query text.
+
+    MiniLM is uncased and whitespace-insensitive, so queries that normalize to
+    the same key embed identically. Document embedding is passed through.
+    """
+
+    def __init__(self, embeddings: Embeddings, max_size: int = 4096):
+        self.embeddings = embeddings
+        self.max_size = max_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        key = normalize_query(text)
+        with self._lock:
+            vector = self._cache.get(key)
+            if vector is not None:
+                self._cache.move_to_end(key)
+                return list(vector)
+
+        vector = tuple(self.embeddings.embed_query(key))
+        with self._lock:
+            self._cache[key] = vector
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+        return list(vector)
+
+class ResponseCache:
+    """Two-tier cache for RAG results.
+
+    Lookups first try the normalized query text, then fall back to the most
+    similar recently answered query by embedding cosine similarity.
+    """
+
+    def __init__(self, embed_query: Callable[[str], List[float]], max_size: int = 512,
+                 semantic_size: int = 256, similarity_threshold: float = 0.95):
+        self.embed_query = embed_query
+        self.max_size = max_size
+        self.similarity_threshold = similarity_threshold
+        self._exact = OrderedDict()
+        self._semantic = deque(maxlen=semantic_size)
+        self._lock = threading.Lock()
+
+    def get_or_invoke(self, query: str, invoke: Callable[[str], dict]) -> dict:
+        """Return a cached result for the query, or call ``invoke`` and cache its result"""
+        return self.get_or_invoke_batch([query], lambda queries: [invoke(queries[0])])[0]
+
+    def get_or_invoke_batch(self, queries: List[str],
+                            invoke_batch: Callable[[List[str]], List[dict]]) -> List[dict]:
+        """Resolve several queries, sending only the cache misses to ``invoke_batch`` in one call"""
+        results, misses = self.lookup_batch(queries)
+        if misses:
+            self.store_batch(results, misses, invoke_batch([miss.query for miss in misses]))
+        return results
+
+    def lookup_batch(self, queries: List[str]) -> Tuple[List[Optional[dict]], List[CacheMiss]]:
+        """Look up several queries; returns the results (None where missed) and the misses.
+
+        Embeds queries for the semantic tier, so async callers should run it in a
+        thread, answer the misses themselves and hand them to ``store_batch``.
+        """
+        results = [None] * len(queries)
+        misses = {}  # normalized key -> CacheMiss
+
+        for i, query in enumerate(queries):
+            key = normalize_query(query)
+            if key in misses:
+                misses[key].indices.append(i)
+                continue
+
+            with self._lock:
+                result = self._exact.get(key)
+                if result is not None:
+                    self._exact.move_to_end(key)
+            if result is None:
+                vector = self._embed(key)
+                if vector is not None:
+                    result = self._semantic_lookup(vector)
+                    if result is not None:
+                        logger.info(f"Semantic cache hit for query: {query[:50]}...")
+                        self._store_exact(key, result)
+            if result is None:
+                misses[key] = CacheMiss(query, key, vector, [i])
+            else:
+                results[i] = result
+        return results, list(misses.values())
+
+    def store_batch(self, results: List[Optional[dict]], misses: List[CacheMiss], fresh: List[dict]):
+        """Fill the missed positions of ``results`` with ``fresh`` answers and cache them"""
+        for miss, result in zip(misses, fresh):
+            for i in miss.indices:
+                results[i] = result
+
+            # Never cache failures such as exceeded quotas; the next attempt may succeed
+            if result.get('guardrail_result', {}).get('quality') != 'error':
+                self._store_exact(miss.key, result)
+                if miss.vector is not None:
+                    with self._lock:
+                        self._semantic.append((miss.vector, result))
+
+    def clear(self):
+        """Drop all cached results, e.g. after the document index changes"""
+        with self._lock:
+            self._exact.clear()
+            self._semantic.clear()
+
+    def _embed(self, text: str) -> Optional[np.ndarray]:
+        """Embed text as a unit vector, or return None if embedding fails"""
+        try:
+            vector = np.asarray(self.embed_query(text), dtype=np.float32)
+        except Exception as e:
+            logger.warning(f"Skipping semantic cache, embedding failed: {e}")
+            return None
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else None
+
+    def _semantic_lookup(self, vector: np.ndarray) -> Optional[dict]:
+        """Return the result of the most similar cached query above the threshold"""
+        with self._lock:
+            if not self._semantic:
+                return None
+            vectors, results = zip(*self._semantic)
+
+        similarities = np.stack(vectors) @ vector
+        best = int(np.argmax(similarities))
+        if similarities[best] >= self.similarity_threshold:
+            return results[best]
+        return None
+
+    def _store_exact(self, key: str, result: dict):
+        with self._lock:
+            self._exact[key] = result
+            self._exact.move_to_end(key)
+            while len(self._exact) > self.max_size:
+                self._exact.popitem(last=False)